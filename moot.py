@@ -3,24 +3,37 @@
 __version__ = "0.1.0"
 
 import argparse
+import array
 import itertools
 import os
+import selectors
+import shutil
 import signal
 import subprocess
 import sys
 import time
-import threading
 import types
 
-READ_SIZE = 4096
-WRITE_SIZE = 4096
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+READ_SIZE = 65536
+WRITE_SIZE = 65536
+PIPE_CAPACITY = 1 << 20
+DISCARD_TAIL_SIZE = 65536
+OUTPUT_TAIL_LINES = 1000
+WRITEV_MAX = 1024  # Linux IOV_MAX
 MAX_LINE_LENGTH = 77
 MAX_SHELL_COMMAND_LINES = 4
 PROCESS_WAIT_LOOP_POLL = 0.4
+SPINNER_FRAMES = [b"\b-", b"\b\\", b"\b|", b"\b/"]
 STDOUT = 1
 STDERR = 2
 
-received_sigterm = False
+received_signal = None
+signal_wakeup_read = None
 
 
 def get_parser():
@@ -34,7 +47,6 @@ def get_parser():
     parser.add_argument(
         "-l",
         "--log",
-        nargs=1,
         help="additionally write output to FILE",
         metavar="FILE",
     )
@@ -68,26 +80,30 @@ def get_parser():
 
 
 def get_config(argv, environ):
-    args = []
-    end_of_options = False
-    for arg in argv[1:]:
-        if not end_of_options:
+    if len(argv) == 2 and not argv[1].startswith("-"):
+        # Trivial `moot SUMMARY` invocation; skip argparse entirely
+        config = argparse.Namespace(
+            log=None,
+            always_output=False,
+            color=True,
+            info=True,
+            timestamps=True,
+            summary=argv[1],
+            command=[],
+        )
+    else:
+        args = argv[1:]
+        # Insert "--" before the first positional (skipping a --log value)
+        # so everything after SUMMARY belongs to COMMAND
+        for i, arg in enumerate(args):
             if arg == "--":
-                end_of_options = True
-            elif not arg.startswith("-") and not (
-                args and (args[-1] == "-l" or args[-1] == "--log")
+                break
+            if not arg.startswith("-") and (
+                i == 0 or args[i - 1] not in ("-l", "--log")
             ):
-                args.append("--")
-                end_of_options = True
-        args.append(arg)
-
-    config = get_parser().parse_args(args)
-
-    # argparse confusingly uses a list for nargs=1
-    for key in ("log", "summary"):
-        value = getattr(config, key)
-        if type(value) is list:
-            setattr(config, key, value[0])
+                args = args[:i] + ["--"] + args[i:]
+                break
+        config = get_parser().parse_args(args)
 
     if config.command:
         config.shell = False
@@ -101,28 +117,49 @@ def get_config(argv, environ):
 
 
 class Printer(object):
+    OK_COLOR = b"\x1b[33m"  # Brown
+    ERROR_COLOR = b"\x1b[31m"  # Red
+    SYSTEM_COLOR = b"\x1b[36m"  # Cyan
+    RESET_COLOR = b"\x1b[0m"
+
     def __init__(self, file=None, color=False):
         self.file = file
+        # Write bytes straight to the underlying buffer; a text file's
+        # encode/decode round trip is skipped entirely
+        self.buffer = getattr(file, "buffer", file)
         self.color = color
+        if color:
+            self._ok = self.OK_COLOR
+            self._error = self.ERROR_COLOR
+            self._system = self.SYSTEM_COLOR
+            self._reset = self.RESET_COLOR
+        else:
+            self._ok = self._error = self._system = self._reset = b""
 
-    def print(self, *args, **kwargs):
-        print(*args, file=self.file, **kwargs)
+    def print(self, data=b"", end=b"\n", flush=False):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(end, str):
+            end = end.encode("utf-8")
+        self.buffer.write(data + end)
+        if flush:
+            self.buffer.flush()
 
-    def print_color(self, code):
-        if self.color:
-            self.print("\x1b[%dm" % code, end="")
+    def print_color(self, data):
+        if data:
+            self.buffer.write(data)
 
     def ok_color(self):
-        self.print_color(33)  # Brown
+        self.print_color(self._ok)
 
     def error_color(self):
-        self.print_color(31)  # Red
+        self.print_color(self._error)
 
     def system_color(self):
-        self.print_color(36)  # Cyan
+        self.print_color(self._system)
 
     def reset_color(self):
-        self.print_color(0)  # Reset
+        self.print_color(self._reset)
 
     def summary(self, summary):
         self.print(summary, end="", flush=True)
@@ -142,27 +179,64 @@ class Printer(object):
             self.system_color()
         self.print("$ " + " ".join(process.command))
         if process.shell_commands:
-            lines = process.shell_commands.decode("utf-8").rstrip().split("\n")
+            lines = process.shell_commands.rstrip().split(b"\n")
             if len(lines) > MAX_SHELL_COMMAND_LINES:
                 lines = lines[:MAX_SHELL_COMMAND_LINES]
-                lines[-1] += " ..."
+                lines[-1] += b" ..."
             for line in lines:
-                self.print("> " + line)
+                self.print(b"> " + line)
         self.reset_color()
 
+    def report_line(self, kind, elapsed, data, timestamps=True):
+        chunks = []
+        if timestamps:
+            if kind == STDERR:
+                l, r = "{", "}"
+            else:
+                l, r = "[", "]"
+            chunks.append(("%s%s%s " % (l, round(elapsed, 1), r)).encode("utf-8"))
+        chunks.append(data)
+        chunks.append(b"\n")
+        self.write_chunks(chunks)
+
     def report_main(self, process, timestamps=True):
-        duration = str(round(process.ended - process.started, 1))
+        if not process.output:
+            return
+        started = process.started
+        width = len(str(round(process.ended - started, 1)))
+        buf = bytearray()
+        buf += self._ok
         for kind, ts, data in process.output:
-            self.ok_color()
             if timestamps:
                 if kind == STDERR:
-                    l, r = "{", "}"
+                    l, r = b"{", b"} "
                 else:
-                    l, r = "[", "]"
-                elapsed = str(round(ts - process.started, 1)).rjust(len(duration))
-                self.print("%s%s%s " % (l, elapsed, r), end="")
-            self.print(data.decode("utf-8"))
-            self.reset_color()
+                    l, r = b"[", b"] "
+                buf += l
+                buf += str(round(ts - started, 1)).rjust(width).encode("ascii")
+                buf += r
+            buf += data
+            buf += b"\n"
+        buf += self._reset
+        self.write_chunks([buf])
+
+    def write_chunks(self, chunks):
+        self.buffer.flush()
+        try:
+            fd = self.buffer.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is None or not hasattr(os, "writev"):
+            self.buffer.write(b"".join(chunks))
+            return
+        for pos in range(0, len(chunks), WRITEV_MAX):
+            group = chunks[pos : (pos + WRITEV_MAX)]
+            written = os.writev(fd, group)
+            if written < sum(map(len, group)):
+                # writev may return short on a pipe or tty; finish with os.write
+                rest = b"".join(group)[written:]
+                while rest:
+                    rest = rest[os.write(fd, rest) :]
 
     def report_footer(self, process):
         if process.errored:
@@ -182,6 +256,38 @@ class Printer(object):
             self.report_footer(process)
 
 
+class OutputBuffer(object):
+    # Columnar storage: one byte per kind, a packed double per timestamp
+    # and a list of line bytes, instead of a tuple per line
+    def __init__(self, maxlen=None):
+        self.kinds = bytearray()
+        self.times = array.array("d")
+        self.lines = []
+        self.maxlen = maxlen
+
+    def append(self, kind, ts, data):
+        self.kinds.append(kind)
+        self.times.append(ts)
+        self.lines.append(data)
+        if self.maxlen is not None and len(self.lines) >= 2 * self.maxlen:
+            self.trim()
+
+    def trim(self):
+        excess = len(self.lines) - self.maxlen
+        if excess > 0:
+            del self.kinds[:excess]
+            del self.times[:excess]
+            del self.lines[:excess]
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        if self.maxlen is not None:
+            self.trim()
+        return zip(self.kinds, self.times, self.lines)
+
+
 class NullPrinter(object):
     def __getattr__(self, name):
         def method(*args, **kwargs):
@@ -190,52 +296,61 @@ class NullPrinter(object):
         return method
 
 
-def start_thread(name, target, *args):
-    thread = threading.Thread(name=name, target=target, args=args)
-    thread.daemon = True
-    thread.start()
-    return thread
+def handle_input(fd, state):
+    chunk = state.data[state.pos : (state.pos + WRITE_SIZE)]
+    if not chunk:
+        return False
+    try:
+        state.pos += os.write(fd, chunk)
+    except BlockingIOError:
+        pass
+    except BrokenPipeError:
+        return False
+    return True
 
 
-def handle_input(pipe, data):
-    pos = 0
-    while not received_signal:
-        chunk = data[pos : (pos + WRITE_SIZE)]
-        if not chunk:
+def handle_output(kind, fd, state, output, sink=None, buf=None):
+    try:
+        if buf is not None:
+            # Read into the caller's preallocated buffer; only the line
+            # slices that are actually retained get their own allocation
+            n = os.readv(fd, [buf])
+            data = buf
+        else:
+            data = os.read(fd, READ_SIZE)
+            n = len(data)
+    except BlockingIOError:
+        return True
+    if n == 0:
+        if state.prev:
+            line = (kind, state.prev_time, bytes(state.prev))
+            output.append(*line)
+            if sink:
+                sink(*line)
+            del state.prev[:]
+        return False
+    ts = time.time()
+    mv = memoryview(data)
+    start = 0
+    while True:
+        idx = data.find(b"\n", start, n)
+        if idx < 0:
             break
-        os.write(pipe.fileno(), chunk)
-        pos += WRITE_SIZE
-    pipe.close()
-
-
-def handle_output(kind, pipe, output, lock):
-    prev_data = b""
-    prev_time = None
-    while not received_signal:
-        data = os.read(pipe.fileno(), READ_SIZE)
-        with lock:
-            if data == b"":
-                if prev_data:
-                    output.append((kind, prev_time, prev_data))
-                break
-            lines = data.split(b"\n")
-            if len(lines) == 1:
-                prev_data += lines[0]
-                if not prev_time:
-                    prev_time = time.time()
-            else:
-                if prev_data:
-                    output.append((kind, prev_time, prev_data + lines[0]))
-                    prev_data = b""
-                    prev_time = None
-                    lines.pop(0)
-                if lines[-1]:
-                    prev_data += lines[-1]
-                    prev_time = time.time()
-                lines.pop()
-                for line in lines:
-                    output.append((kind, time.time(), line))
-    pipe.close()
+        if state.prev:
+            line = (kind, state.prev_time, bytes(state.prev) + bytes(mv[start:idx]))
+            del state.prev[:]
+            state.prev_time = None
+        else:
+            line = (kind, ts, bytes(mv[start:idx]))
+        output.append(*line)
+        if sink:
+            sink(*line)
+        start = idx + 1
+    if start < n:
+        if not state.prev:
+            state.prev_time = ts
+        state.prev += mv[start:n]
+    return True
 
 
 def setup_signal_handler():
@@ -249,30 +364,169 @@ def setup_signal_handler():
 
     [setup_signal(name) for name in ["SIGTERM", "SIGINT"]]
 
-    global received_signal
-    received_signal = None
+    # Signal delivery also writes the signal number to this pipe, so a
+    # selector blocked in select() wakes up deterministically
+    global signal_wakeup_read
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal_wakeup_read = wakeup_read
 
 
-def wait_for_process(process, spin_out=None):
-    spinner = itertools.cycle(["-", "\\", "|", "/"])
-    first = True
-    while True:
+def advance_spinner(spin_out, spinner, first):
+    frame = next(spinner)
+    if first:
+        frame = b" " + frame[1:]
+    os.write(spin_out.fileno(), frame)
+    return False
+
+
+def handle_discard(fd, state):
+    # Move output into the tail pipe without copying it through userspace;
+    # when the tail pipe is full, evict its oldest half into /dev/null so it
+    # keeps a rolling window of the most recent output for error reporting.
+    try:
+        n = os.splice(fd, state.tail_write, READ_SIZE)
+    except BlockingIOError:
         try:
-            process.wait(PROCESS_WAIT_LOOP_POLL)
-            if spin_out and not first:
-                spin_out.write("\b\b")
-            break
-        except subprocess.TimeoutExpired:
+            os.splice(state.tail_read, state.devnull, DISCARD_TAIL_SIZE // 2)
+        except BlockingIOError:
+            pass
+        return True
+    return n != 0
+
+
+def run_event_loop(
+    process, output, stdin_data=None, spin_out=None, discard=False, sink=None
+):
+    spinner = itertools.cycle(SPINNER_FRAMES)
+    first = True
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfd_open (non-Linux or pre-3.9), poll for exit instead
+        pidfd = None
+
+    wakeup_read = signal_wakeup_read
+    selector = selectors.DefaultSelector()
+    if wakeup_read is not None:
+        selector.register(wakeup_read, selectors.EVENT_READ)
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ)
+
+    use_splice = discard and hasattr(os, "splice")
+    devnull = os.open(os.devnull, os.O_WRONLY) if use_splice else None
+    streams = {}
+    for kind, pipe in ((STDOUT, process.stdout), (STDERR, process.stderr)):
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+        selector.register(fd, selectors.EVENT_READ)
+        state = types.SimpleNamespace(
+            kind=kind, pipe=pipe, prev=bytearray(), prev_time=None
+        )
+        if use_splice:
+            state.tail_read, state.tail_write = os.pipe()
+            os.set_blocking(state.tail_read, False)
+            os.set_blocking(state.tail_write, False)
+            state.devnull = devnull
+        streams[fd] = state
+
+    if stdin_data is not None:
+        stdin_fd = process.stdin.fileno()
+        os.set_blocking(stdin_fd, False)
+        selector.register(stdin_fd, selectors.EVENT_WRITE)
+        # memoryview so per-write slices don't copy the shell script
+        stdin_state = types.SimpleNamespace(
+            pipe=process.stdin, data=memoryview(stdin_data), pos=0
+        )
+    else:
+        stdin_fd = None
+        stdin_state = None
+
+    read_buf = bytearray(READ_SIZE) if hasattr(os, "readv") else None
+    if spin_out:
+        spin_deadline = time.monotonic() + PROCESS_WAIT_LOOP_POLL
+    open_reads = len(streams)
+    exited = False
+    terminated = False
+    try:
+        while open_reads or not exited:
+            # The spinner runs off the clock, not off select idleness, so a
+            # chatty child that keeps the selector busy can't starve it
             if spin_out:
-                if first:
-                    first = False
-                    spin_out.write(" ")
+                now = time.monotonic()
+                if now >= spin_deadline:
+                    first = advance_spinner(spin_out, spinner, first)
+                    spin_deadline = now + PROCESS_WAIT_LOOP_POLL
+                timeout = max(0.0, spin_deadline - time.monotonic())
+            elif pidfd is None and not exited:
+                timeout = PROCESS_WAIT_LOOP_POLL
+            else:
+                timeout = None
+            ready = selector.select(timeout)
+            if not ready:
+                if pidfd is None and not exited and process.poll() is not None:
+                    exited = True
+                continue
+            for key, events in ready:
+                fd = key.fd
+                if fd == wakeup_read:
+                    os.read(wakeup_read, READ_SIZE)
+                    if received_signal and not terminated:
+                        process.terminate()
+                        terminated = True
+                elif fd == pidfd:
+                    process.wait()
+                    exited = True
+                    selector.unregister(pidfd)
+                    os.close(pidfd)
+                    pidfd = None
+                elif fd == stdin_fd:
+                    if not handle_input(fd, stdin_state):
+                        selector.unregister(fd)
+                        stdin_state.pipe.close()
+                        stdin_fd = None
                 else:
-                    spin_out.write("\b")
-                spin_out.write(next(spinner))
-                spin_out.flush()
-            if received_signal:
-                break
+                    state = streams[fd]
+                    if use_splice:
+                        more = handle_discard(fd, state)
+                    else:
+                        more = handle_output(
+                            state.kind, fd, state, output, sink, read_buf
+                        )
+                    if not more:
+                        selector.unregister(fd)
+                        state.pipe.close()
+                        open_reads -= 1
+    finally:
+        selector.close()
+        if use_splice:
+            # Recover the retained tail so error reporting still has output
+            for state in streams.values():
+                os.close(state.tail_write)
+                while handle_output(
+                    state.kind, state.tail_read, state, output, sink, read_buf
+                ):
+                    pass
+                os.close(state.tail_read)
+            os.close(devnull)
+        if pidfd is not None:
+            os.close(pidfd)
+        if spin_out and not first:
+            os.write(spin_out.fileno(), b"\b\b")
+
+
+def set_pipe_capacity(process):
+    # Grow the kernel pipe buffers so bursty writers don't stall (Linux only)
+    if not fcntl or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    for pipe in (process.stdin, process.stdout, process.stderr):
+        if pipe:
+            try:
+                fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_CAPACITY)
+            except OSError:
+                pass
 
 
 def slurp(file):
@@ -285,7 +539,15 @@ def slurp(file):
     return b"".join(buffer)
 
 
-def run_command(command, shell=False, shell_env=None, spin_out=None, stdin=None):
+def run_command(
+    command,
+    shell=False,
+    shell_env=None,
+    spin_out=None,
+    stdin=None,
+    discard=False,
+    sink=None,
+):
     if shell and stdin:
         shell_commands = slurp(stdin)
     else:
@@ -294,66 +556,99 @@ def run_command(command, shell=False, shell_env=None, spin_out=None, stdin=None)
     result = types.SimpleNamespace(
         command=command,
         shell_commands=shell_commands,
-        output=[],
+        # The sink receives every line as it arrives, so memory only needs
+        # to hold a bounded tail for error reporting
+        output=OutputBuffer(maxlen=OUTPUT_TAIL_LINES if sink else None),
         started=time.time(),
         ended=None,
         errored=True,
     )
 
+    if sink:
+
+        def line_sink(kind, ts, data):
+            sink(result, kind, ts, data)
+
+    else:
+        line_sink = None
+
+    # subprocess only takes its posix_spawn (vfork) fast path when close_fds
+    # is off and the executable is a resolved path, so resolve bare command
+    # names here; Python-created fds are non-inheritable anyway (PEP 446)
+    if os.sep in result.command[0]:
+        executable = None
+    else:
+        executable = shutil.which(result.command[0])
+
+    if shell_commands:
+        child_stdin = subprocess.PIPE
+    else:
+        child_stdin = stdin
+        try:
+            # Our own stdin is inherited by the child either way, but
+            # passing it explicitly as fd 0 disqualifies the posix_spawn
+            # fast path; None keeps subprocess on it
+            if stdin is not None and stdin.fileno() == 0:
+                child_stdin = None
+        except (AttributeError, OSError, ValueError):
+            pass
+
     process = None
     try:
         process = subprocess.Popen(
             result.command,
-            stdin=(subprocess.PIPE if shell_commands else stdin),
+            executable=executable,
+            close_fds=False,
+            stdin=child_stdin,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
     except FileNotFoundError:
-        result.output.append(
-            (
-                STDERR,
-                time.time(),
-                b"Command not found: " + command[0].encode("utf-8"),
-            )
+        line = (
+            STDERR,
+            time.time(),
+            b"Command not found: " + command[0].encode("utf-8"),
         )
+        result.output.append(*line)
+        if line_sink:
+            line_sink(*line)
         result.ended = time.time()
         result.returncode = 1
         return result
 
-    lock = threading.Lock()
+    set_pipe_capacity(process)
+
     if process.stdin and shell_commands:
         stdin_data = (shell_env or "").encode("utf-8") + b"\n" + shell_commands
-        stdin_thread = start_thread("stdin", handle_input, process.stdin, stdin_data)
     else:
-        stdin_thread = None
-    stdout_thread = start_thread(
-        "stdout", handle_output, STDOUT, process.stdout, result.output, lock
-    )
-    stderr_thread = start_thread(
-        "stderr", handle_output, STDERR, process.stderr, result.output, lock
-    )
+        stdin_data = None
 
     try:
-        wait_for_process(process, spin_out=spin_out)
+        run_event_loop(
+            process,
+            result.output,
+            stdin_data=stdin_data,
+            spin_out=spin_out,
+            discard=discard,
+            sink=line_sink,
+        )
         if received_signal:
-            process.terminate()
             data = ("Received: " + str(received_signal)).encode("utf-8")
-            with lock:
-                result.output.append((STDERR, time.time(), data))
+            line = (STDERR, time.time(), data)
+            result.output.append(*line)
+            if line_sink:
+                line_sink(*line)
             result.returncode = -int(received_signal)
         else:
             result.returncode = process.returncode
     except BaseException as e:
         data = ("Exception: " + repr(e)).encode("utf-8")
-        with lock:
-            result.output.append((STDERR, time.time(), data))
+        line = (STDERR, time.time(), data)
+        result.output.append(*line)
+        if line_sink:
+            line_sink(*line)
         process.terminate()
         result.returncode = -2
-    finally:
-        if stdin_thread:
-            stdin_thread.join()
-        stdout_thread.join()
-        stderr_thread.join()
 
     result.ended = time.time()
     result.errored = result.returncode != 0
@@ -371,7 +666,7 @@ def main():
 
     out = Printer(file=stdout, color=color)
     if config.log:
-        logfile = open(config.log, "a", encoding="utf-8")
+        logfile = open(config.log, "ab")
         log = Printer(file=logfile, color=False)
     else:
         log = NullPrinter()
@@ -380,12 +675,36 @@ def main():
         out.summary(config.summary)
         log.summary(config.summary)
 
+    if config.log:
+        # Stream lines to the log as they arrive instead of retaining them;
+        # the header goes out just before the first line
+        log.print()
+        log_state = types.SimpleNamespace(header=False)
+
+        def log_sink(process, kind, ts, data):
+            if not log_state.header:
+                log_state.header = True
+                if config.info:
+                    log.report_header(process)
+            log.report_line(
+                kind, ts - process.started, data, timestamps=config.timestamps
+            )
+
+    else:
+        log_sink = None
+
+    # Without --always-output or a log, output is only ever shown on error,
+    # so the bulk of it can be discarded in the kernel with just a tail kept
+    discard = not config.always_output and not config.log
+
     process = run_command(
         config.command,
         shell=config.shell,
         shell_env=config.shell_env,
         spin_out=spin_out,
         stdin=stdin,
+        discard=discard,
+        sink=log_sink,
     )
 
     if config.summary:
@@ -398,7 +717,10 @@ def main():
 
     if config.always_output or process.errored:
         out.report(process, info=config.info, timestamps=config.timestamps)
-    log.report(process, info=config.info, timestamps=config.timestamps)
+    if config.log and config.info:
+        if not log_state.header:
+            log.report_header(process)
+        log.report_footer(process)
 
     sys.exit(process.returncode)
 